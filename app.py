@@ -1,93 +1,209 @@
 from flask import Flask, render_template, request, jsonify
-from docx import Document
+from lxml import etree
+from markupsafe import escape
+import atexit
+import multiprocessing
+import os
 import re
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from io import BytesIO, StringIO
 
 app = Flask(__name__)
 
+# Multi-file uploads are held in memory while they are parsed, so cap the request size
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+
 # Version number
 VERSION = "1.0.3"
 
-def detect_document_type(doc):
-    """Detect if document is birthdays or service anniversaries"""
-    # Collect all text lines (splitting paragraphs by line breaks)
-    all_lines = []
-    for para in doc.paragraphs:
-        text = para.text.strip()
-        if text:
-            # Split by line breaks within the paragraph
-            lines = text.split('\n')
-            all_lines.extend([line.strip() for line in lines if line.strip()])
+# Worker pool for parsing multi-file uploads, created on first use and kept
+# small since every server process gets its own
+POOL_WORKERS = min(4, os.cpu_count() or 1)
+_pool = None
+_pool_lock = threading.Lock()
+
+# WordprocessingML namespace and the queries used to read document.xml
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+NSMAP = {'w': W_NS}
+W_P = f'{{{W_NS}}}p'
+W_TXBX = f'{{{W_NS}}}txbxContent'
+RUN_CONTENT = etree.XPath('./w:r/* | ./w:hyperlink/w:r/*', namespaces=NSMAP)
+W_TEXT = f'{{{W_NS}}}t'
+W_BR = f'{{{W_NS}}}br'
+W_TYPE = f'{{{W_NS}}}type'
+# Run content with a fixed text equivalent, as python-docx reads it
+W_CHARS = {
+    f'{{{W_NS}}}tab': '\t',
+    f'{{{W_NS}}}ptab': '\t',
+    f'{{{W_NS}}}cr': '\n',
+    f'{{{W_NS}}}noBreakHyphen': '-',
+}
+
+# Header patterns, compiled once at import
+DATE_PATTERN = re.compile(r'^[A-Z][a-z]+\s+\d+$')
+YEAR_UNITS = frozenset(('year', 'years'))
+
+def is_year_line(line):
+    """Check if a line is a service header like '5 years'"""
+    # Split and compare the case-folded unit instead of a case-insensitive regex
+    parts = line.split()
+    return len(parts) == 2 and parts[0].isdecimal() and parts[1].casefold() in YEAR_UNITS
+
+def paragraph_text(p):
+    """Return the text of a <w:p> element, with line breaks as newlines"""
+    parts = []
+    # Bind globals and the append method to locals for the per-run loop
+    append = parts.append
+    w_text, w_br, w_type, w_chars = W_TEXT, W_BR, W_TYPE, W_CHARS
     
-    # Check the lines for patterns
-    for line in all_lines:
-        # Check for service anniversary pattern (e.g., "1 year", "5 years")
-        if re.match(r'^\d+\s+years?$', line, re.IGNORECASE):
-            return 'service'
-        # Check for birthday pattern (month and day)
-        if re.match(r'^[A-Z][a-z]+\s+\d+$', line):
-            return 'birthday'
+    for el in RUN_CONTENT(p):
+        tag = el.tag
+        if tag == w_text:
+            append(el.text or '')
+        elif tag == w_br:
+            # Only line breaks split text; page and column breaks add nothing
+            if el.get(w_type, 'textWrapping') == 'textWrapping':
+                append('\n')
+        elif tag in w_chars:
+            append(w_chars[tag])
+    return ''.join(parts)
+
+def iter_lines(source):
+    """Yield non-empty lines from a .docx file, splitting paragraphs by line breaks"""
+    text_of = paragraph_text
+    with zipfile.ZipFile(source) as z:
+        with z.open('word/document.xml') as xml:
+            # Stream body and table paragraphs; never expand entities
+            for _, p in etree.iterparse(xml, events=('end',), tag=W_P, resolve_entities=False):
+                # Word saves each text box twice (mc:Choice and mc:Fallback), so
+                # paragraphs inside one are skipped; only body and cell text counts.
+                # Text-box paragraphs are the only nested ones, and their end event
+                # fires before the enclosing paragraph's, so skipping them also
+                # keeps lines in document order
+                if next(p.iterancestors(W_TXBX), None) is not None:
+                    continue
+                
+                # Each line is stripped on its own, so the paragraph needs no strip
+                for line in text_of(p).split('\n'):
+                    line = line.strip()
+                    if line:
+                        yield line
+                
+                # Free the finished paragraph and everything finished before it:
+                # earlier siblings of the paragraph and of each enclosing cell,
+                # row and table
+                p.clear()
+                el, parent = p, p.getparent()
+                while parent is not None:
+                    while el.getprevious() is not None:
+                        del parent[0]
+                    el, parent = parent, parent.getparent()
+
+def classify_line(line):
+    """Return 'birthday' for a date header, 'service' for a year header, else None"""
+    first = line[0]
+    if first.isdigit():
+        # Service anniversary header (e.g., "1 year", "5 years")
+        return 'service' if is_year_line(line) else None
+    # Most lines are names: only a date header like "April 6" starts upper-case
+    # and ends in a digit, so the regex runs only for those
+    if first.isupper() and line[-1].isdigit() and DATE_PATTERN.match(line):
+        return 'birthday'
+    return None
+
+def detect_document_type(line_types):
+    """Detect if document is birthdays or service anniversaries"""
+    # The first header found decides the type
+    for line_type in line_types:
+        if line_type:
+            return line_type
     
     return 'unknown'
 
-def parse_birthday_document(doc):
-    """Parse birthday document and extract data"""
-    dates_data = {}
-    current_date = None
+def group_lines(lines, line_types, header_type):
+    """Group lines under the headers of the given type"""
+    groups = {}
+    current_header = None
     
-    # Process all paragraphs and split by line breaks
-    for para in doc.paragraphs:
-        text = para.text.strip()
-        if not text:
-            continue
-        
-        # Split by line breaks within the paragraph
-        lines = text.split('\n')
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            
-            # Check if this matches a date pattern like "April 6"
-            if re.match(r'^[A-Z][a-z]+\s+\d+$', line):
-                current_date = line
-                dates_data[current_date] = []
-            elif current_date:
-                # This is a name under the current date
-                dates_data[current_date].append(line)
+    for line, line_type in zip(lines, line_types):
+        if line_type == header_type:
+            # A repeated header continues its earlier group
+            current_header = line
+            groups.setdefault(current_header, [])
+        elif current_header:
+            # This is a name under the current header
+            groups[current_header].append(line)
     
-    return dates_data
+    return groups
 
-def parse_service_document(doc):
-    """Parse service anniversary document and extract data"""
-    sections = {}
-    current_section = None
+def parse_document(source):
+    """Detect the document type and parse it, returning (doc_type, data)"""
+    lines = list(iter_lines(source))
     
-    # Process all paragraphs and split by line breaks
-    for para in doc.paragraphs:
-        text = para.text.strip()
-        if not text:
-            continue
-        
-        # Split by line breaks within the paragraph
-        lines = text.split('\n')
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            
-            # Check if this matches a year pattern like "1 year" or "5 years"
-            year_match = re.match(r'^(\d+)\s+years?$', line, re.IGNORECASE)
-            if year_match:
-                current_section = line
-                sections[current_section] = []
-            elif current_section:
-                # This is a name under the current section
-                sections[current_section].append(line)
+    # Classify every line once; detection and grouping share the result
+    line_types = list(map(classify_line, lines))
+    doc_type = detect_document_type(line_types)
     
-    return sections
+    if doc_type == 'unknown':
+        return doc_type, {}
+    return doc_type, group_lines(lines, line_types, doc_type)
+
+def parse_document_bytes(data):
+    """Parse a .docx held in memory (picklable entry point for worker processes)"""
+    return parse_document(BytesIO(data))
+
+def get_pool():
+    """Return the shared worker pool, starting it on first use"""
+    global _pool
+    # The threaded dev server can race here, so only one pool is created
+    with _pool_lock:
+        if _pool is None:
+            # Request threads may hold locks when the pool starts, so workers
+            # are spawned rather than forked from this process
+            _pool = ProcessPoolExecutor(
+                max_workers=POOL_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _pool
+
+def discard_pool(pool):
+    """Drop a broken pool so the next upload starts a fresh one"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+def shutdown_pool():
+    """Stop the worker pool at interpreter exit, if it was started"""
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+
+atexit.register(shutdown_pool)
+
+def parse_in_pool(payloads):
+    """Parse in-memory documents across the worker pool"""
+    pool = get_pool()
+    try:
+        return list(pool.map(parse_document_bytes, payloads))
+    except BrokenProcessPool:
+        # A dead worker breaks the whole executor. The payload that killed it
+        # would likely do so again, so don't retry; the next upload gets a new pool
+        discard_pool(pool)
+        raise
+
+def merge_parsed(results):
+    """Merge parsed documents, keeping headers in first-seen order"""
+    merged = {}
+    for _, data in results:
+        for header, names in data.items():
+            merged.setdefault(header, []).extend(names)
+    return merged
 
 def split_cols(names):
     """Split names into 3 columns for service anniversaries"""
@@ -100,89 +216,88 @@ def split_cols(names):
 
 def generate_birthday_html(dates_data):
     """Generate Bootstrap HTML from birthday/date data"""
-    html_parts = []
-    dates = list(dates_data.keys())
+    items = list(dates_data.items())
     
-    # Process dates in groups of 4 (col-md-3 means 4 columns per row)
-    for i in range(0, len(dates), 4):
-        html_parts.append('<div class="row">')
-        
-        # Get up to 4 dates for this row
-        row_dates = dates[i:i+4]
-        
-        for date in row_dates:
-            names = dates_data[date]
-            names_html = ' <br/> '.join(names)
-            
-            html_parts.append(f'''  <div class="col-md-3">
-    <h3>{date}<br/></h3>
-    <p>{names_html}</p>
-  </div>''')
-        
-        html_parts.append('</div>')
+    # Group dates in rows of 4 (col-md-3 means 4 columns per row)
+    rows = [items[i:i+4] for i in range(0, len(items), 4)]
     
-    return '\n'.join(html_parts)
+    # The template autoescapes dates and names
+    return render_template('_birthday_grid.html', rows=rows)
 
 def generate_service_html(sections):
     """Generate Bootstrap HTML from service anniversary data"""
-    html_parts = []
+    # Write straight into one buffer rather than joining a list of fragments
+    buf = StringIO()
+    w = buf.write
     
-    for section, names in sections.items():
-        cols = split_cols(names)
-        html_parts.append(f'<p>\n   <strong>{section}</strong></p>')
-        html_parts.append('<div class="row">')
+    for i, (section, names) in enumerate(sections.items()):
+        if i:
+            w('\n')
+        # Escape headers and names as the birthday template does
+        w(f'<p>\n   <strong>{escape(section)}</strong></p>\n')
+        w('<div class="row">\n')
         
-        for col in cols:
-            html_parts.append('   <div class="col-md-4">')
+        for col in split_cols(names):
+            w('   <div class="col-md-4">\n')
             if col:
-                html_parts.append('      <p>' + '<br/> '.join(col) + '</p>')
+                w('      <p>' + '<br/> '.join(map(escape, col)) + '</p>\n')
             else:
-                html_parts.append('      <p>&#160;</p>')
-            html_parts.append('   </div>')
+                w('      <p>&#160;</p>\n')
+            w('   </div>\n')
         
-        html_parts.append('</div>')
+        w('</div>')
     
-    return '\n'.join(html_parts)
+    return buf.getvalue()
 
 @app.route('/')
 def index():
     return render_template('index.html', version=VERSION)
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return jsonify({'error': f'Upload is too large (limit {limit_mb} MB)'}), 413
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file uploaded'}), 400
+    files = request.files.getlist('file')
     
-    file = request.files['file']
+    if not files:
+        return jsonify({'error': 'No file uploaded'}), 400
     
-    if file.filename == '':
+    if any(file.filename == '' for file in files):
         return jsonify({'error': 'No file selected'}), 400
     
-    if not file.filename.endswith('.docx'):
+    if not all(file.filename.endswith('.docx') for file in files):
         return jsonify({'error': 'Please upload a .docx file'}), 400
     
     try:
-        # Parse the document
-        doc = Document(file)
+        if len(files) == 1:
+            # The upload stream is seekable, so zipfile reads it in place
+            stream = files[0].stream
+            stream.seek(0)
+            results = [parse_document(stream)]
+        else:
+            # Parse files in parallel; documents travel to workers as bytes
+            payloads = [file.read() for file in files]
+            results = parse_in_pool(payloads)
         
-        # Detect document type
-        doc_type = detect_document_type(doc)
+        doc_types = {doc_type for doc_type, _ in results}
+        if 'unknown' in doc_types:
+            return jsonify({'error': 'Unable to detect document type. Please ensure dates or year headers are in bold.'}), 400
+        if len(doc_types) > 1:
+            return jsonify({'error': 'Please upload documents of a single type'}), 400
         
-        # Reset file pointer for re-reading
-        file.seek(0)
-        doc = Document(file)
+        doc_type = doc_types.pop()
+        data = merge_parsed(results)
         
         if doc_type == 'birthday':
-            data = parse_birthday_document(doc)
             html_output = generate_birthday_html(data)
-            dates = list(data.keys())
-            title = f"{dates[0]} - {dates[-1]} Birthdays" if dates else "Birthdays"
-        elif doc_type == 'service':
-            data = parse_service_document(doc)
+            # Dicts keep insertion order, so the ends give the date range
+            title = f"{next(iter(data))} - {next(reversed(data))} Birthdays" if data else "Birthdays"
+        else:
             html_output = generate_service_html(data)
             title = "Service Anniversaries"
-        else:
-            return jsonify({'error': 'Unable to detect document type. Please ensure dates or year headers are in bold.'}), 400
         
         return jsonify({
             'success': True,